@@ -1,48 +1,121 @@
 import uuid
-import requests
-import base64
+import asyncio
+import aiohttp
+from binascii import a2b_base64
 import logging
-from fastapi import APIRouter, UploadFile, File, HTTPException, Request
-from typing import List, Optional
+import numpy as np
+from fastapi import APIRouter, BackgroundTasks, UploadFile, File, HTTPException, Query, Request
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
-from app.models.image_model import image_to_vector
+from app.models.image_model import images_to_vectors
 from app.db import vector_db
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Tolerance for float32 rounding in inner products of unit vectors,
+# so that identical images still match at a distance threshold of 0
+SIMILARITY_EPS = 1e-6
 
-def process_image(image_bytes: bytes) -> List[float]:
+# Maximum accepted size of a single image and the chunk size used when streaming it
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Longest Base64 encoding of an image within the size limit, including padding
+# and CRLF line breaks every 76 characters as in MIME-wrapped Base64
+MAX_BASE64_LENGTH = 4 * -(-MAX_IMAGE_SIZE // 3)
+MAX_BASE64_LENGTH += 2 * -(-MAX_BASE64_LENGTH // 76)
+
+
+def process_images(images_bytes: List[bytes]) -> np.ndarray:
     """
-    Processes an image and converts it into a vector representation.
+    Processes a batch of images and converts them into vector representations.
 
     Args:
-        image_bytes (bytes): The image data in bytes.
+        images_bytes (List[bytes]): The image data of each image in bytes.
 
     Returns:
-        List[float]: The image vector.
+        np.ndarray: The image vectors, one row per image.
 
     Raises:
-        HTTPException: If the image size exceeds the limit or processing fails.
+        HTTPException: If processing fails.
     """
-    if len(image_bytes) > 10 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="Image size exceeds 10 MB")
-
     try:
-        vector = image_to_vector(image_bytes)
-        return vector
+        vectors = images_to_vectors(images_bytes)
+        return vectors
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
 
+async def read_bounded(stream, limit: int = MAX_IMAGE_SIZE) -> bytes:
+    """
+    Reads a stream in chunks, rejecting it as soon as it grows past the size limit.
+
+    Args:
+        stream: An object with an async read(size) method, such as an UploadFile
+                or an aiohttp response body.
+        limit (int, optional): The maximum number of bytes to accept. Defaults to 10 MB.
+
+    Returns:
+        bytes: The data read from the stream.
+
+    Raises:
+        HTTPException: If the data exceeds the size limit.
+    """
+    buffer = bytearray()
+    while chunk := await stream.read(CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) > limit:
+            raise HTTPException(status_code=400, detail="Image size exceeds 10 MB")
+    return bytes(buffer)
+
+
+async def download_image(session: aiohttp.ClientSession, image_url: str) -> bytes:
+    """
+    Downloads an image from a URL.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session to download with.
+        image_url (str): The URL of the image.
+
+    Returns:
+        bytes: The downloaded image data.
+
+    Raises:
+        HTTPException: If the download fails, exceeds the size limit or returns an empty image.
+    """
+    logger.info(f"Processing image from URL: {image_url}")
+    try:
+        async with session.get(image_url) as response:
+            status_code = response.status
+            if status_code != 200:
+                raise HTTPException(status_code=400, detail=f"Failed to download image from URL: {image_url} "
+                                                            f"(Status code: {status_code})")
+
+            image_bytes = await read_bounded(response.content)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Request failed for URL: {image_url}, Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing image from URL: {str(e)}")
+
+    logger.info(f"URL: {image_url}, Status code: {status_code}, Content length: {len(image_bytes)}")
+
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail=f"Downloaded image is empty from URL: {image_url}")
+
+    return image_bytes
+
+
 @router.post("/images")
-async def add_images(request: Request, files: Optional[List[UploadFile]] = File(None)):
+async def add_images(request: Request, background_tasks: BackgroundTasks,
+                     files: Optional[List[UploadFile]] = File(None)):
     """
     Adds images to the vector database. Supports images uploaded via multipart/form-data,
     Base64-encoded images, and images provided via URLs.
 
     Args:
         request (Request): The FastAPI request object.
+        background_tasks (BackgroundTasks): Tasks to run after the response is sent.
         files (Optional[List[UploadFile]]): List of uploaded files (optional).
 
     Returns:
@@ -53,7 +126,7 @@ async def add_images(request: Request, files: Optional[List[UploadFile]] = File(
         HTTPException: If no valid images are provided or processing fails.
     """
     request_id = str(uuid.uuid4())
-    vectors = []
+    images_bytes = []
 
     # Determine if the content type is JSON to read data accordingly
     if request.headers.get("Content-Type") == "application/json":
@@ -72,66 +145,129 @@ async def add_images(request: Request, files: Optional[List[UploadFile]] = File(
             if file.content_type not in ["image/jpeg", "image/png"]:
                 raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
 
-            image_bytes = await file.read()
-            vector = process_image(image_bytes)
-            vectors.append(vector)
+            image_bytes = await read_bounded(file)
+            images_bytes.append(image_bytes)
 
     # Processing Base64-encoded images
     if data and "base64_images" in data:
         for image_b64 in data["base64_images"]:
+            if not isinstance(image_b64, str):
+                raise HTTPException(status_code=400, detail="Base64 images must be strings")
+
+            # Reject clearly oversized images from the encoded length, before decoding them
+            if len(image_b64) > MAX_BASE64_LENGTH:
+                raise HTTPException(status_code=400, detail="Image size exceeds 10 MB")
+
             try:
-                image_bytes = base64.b64decode(image_b64)
-                vector = process_image(image_bytes)
-                vectors.append(vector)
+                image_bytes = a2b_base64(image_b64)
             except Exception as e:
                 logger.error(f"Error processing Base64 image: {str(e)}")
                 raise HTTPException(status_code=500, detail=f"Error processing Base64 image: {str(e)}")
 
-    # Processing images from URLs
-    if data and "image_urls" in data:
-        for image_url in data["image_urls"]:
-            logger.info(f"Processing image from URL: {image_url}")
-            try:
-                response = requests.get(image_url, timeout=10)
-                logger.info(f"URL: {image_url}, Status code: {response.status_code}, "
-                            f"Content length: {len(response.content)}")
+            # Enforce the exact limit on the decoded image
+            if len(image_bytes) > MAX_IMAGE_SIZE:
+                raise HTTPException(status_code=400, detail="Image size exceeds 10 MB")
 
-                if response.status_code != 200:
-                    raise HTTPException(status_code=400, detail=f"Failed to download image from URL: {image_url} "
-                                                                f"(Status code: {response.status_code})")
+            images_bytes.append(image_bytes)
 
-                image_bytes = response.content
-                if not image_bytes:
-                    raise HTTPException(status_code=400, detail=f"Downloaded image is empty from URL: {image_url}")
+    # Processing images from URLs, downloading them concurrently.
+    # The task group cancels the remaining downloads as soon as one fails
+    if data and "image_urls" in data:
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+                async with asyncio.TaskGroup() as task_group:
+                    downloads = [task_group.create_task(download_image(session, image_url))
+                                 for image_url in data["image_urls"]]
+        except ExceptionGroup as e:
+            raise e.exceptions[0]
 
-                vector = process_image(image_bytes)
-                vectors.append(vector)
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Request failed for URL: {image_url}, Error: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Error processing image from URL: {str(e)}")
+        images_bytes.extend(download.result() for download in downloads)
 
-    if not vectors:
+    if not images_bytes:
         logger.info("No valid vectors were generated from the provided images.")
         raise HTTPException(status_code=400, detail="No valid images provided")
 
-    vector_db.add_vectors(request_id, vectors)
+    # Run a single batched forward pass over all collected images in a worker thread,
+    # keeping the event loop free to serve other requests
+    vectors = await asyncio.to_thread(process_images, images_bytes)
 
-    start_index = len(vector_db.vectors) - len(vectors)
-    end_index = len(vector_db.vectors)
+    start_index, end_index = vector_db.add_vectors(request_id, vectors)
+    background_tasks.add_task(vector_db.rebuild_index)  # Fits the PCA once enough images are stored
     image_names = [f"image_{i}" for i in range(start_index + 1, end_index + 1)]
 
     return {"request_id": request_id, "added_images": len(vectors), "system_image_names": image_names}
 
 
+@router.delete("/images/{request_id}")
+async def remove_images(request_id: str, background_tasks: BackgroundTasks):
+    """
+    Removes the images associated with a given request ID from the vector database.
+
+    Args:
+        request_id (str): The unique ID associated with a set of images.
+        background_tasks (BackgroundTasks): Tasks to run after the response is sent.
+
+    Returns:
+        dict: A dictionary containing the request ID and the number of removed images.
+
+    Raises:
+        HTTPException: If the request ID is not found.
+    """
+    if request_id not in vector_db.request_map:
+        raise HTTPException(status_code=404, detail="Request ID not found")
+
+    start_index, end_index = vector_db.request_map[request_id]
+    vector_db.remove_request(request_id)
+    background_tasks.add_task(vector_db.rebuild_index)  # Compacts the index once enough images are removed
+
+    return {"request_id": request_id, "removed_images": end_index - start_index}
+
+
+@lru_cache(maxsize=1024)
+def find_duplicate_names(request_id: str, threshold: float, k: int, ef: int, version: int) -> Tuple[str, ...]:
+    """
+    Searches for duplicates of the images associated with a request ID. Results are cached
+    per set of arguments, so repeated queries skip the index search.
+
+    Args:
+        request_id (str): The unique ID associated with a set of images.
+        threshold (float): The squared L2 distance threshold between normalized vectors
+                           for considering images as duplicates.
+        k (int): The number of nearest neighbors to search for.
+        ef (int): The HNSW search depth, trading latency for recall.
+        version (int): The current version of the vector database, so that any change
+                       to the database invalidates the cached results.
+
+    Returns:
+        Tuple[str, ...]: The names of the duplicate images.
+    """
+    start_index, end_index = vector_db.request_map[request_id]
+    similarities, indices = vector_db.search_duplicates(request_id, k, ef)
+
+    # On unit vectors the squared L2 distance is 2 - 2 * inner product,
+    # so translate the distance threshold into a minimum inner product
+    min_similarity = 1 - threshold / 2 - SIMILARITY_EPS
+
+    # Keep neighbors within the threshold, excluding each vector's match with itself
+    # and the -1 padding FAISS returns when fewer than k neighbors exist
+    self_indices = np.arange(start_index, end_index)[:, None]
+    mask = (indices != self_indices) & (indices >= 0) & (similarities >= min_similarity)
+    all_duplicates = np.unique(indices[mask])
+
+    return tuple(vector_db.get_image_names(all_duplicates))
+
+
 @router.get("/duplicates/{request_id}")
-async def find_duplicates(request_id: str, threshold: float = 1.0, k: int = 3):
+async def find_duplicates(request_id: str, threshold: float = 0.1, k: int = 3, ef: int = Query(16, ge=1)):
     """
     Finds duplicates for the images associated with a given request ID.
 
     Args:
         request_id (str): The unique ID associated with a set of images.
-        threshold (float, optional): The distance threshold for considering images as duplicates. Defaults to 1.0.
+        threshold (float, optional): The squared L2 distance threshold between normalized vectors
+                                     for considering images as duplicates. Defaults to 0.1.
         k (int, optional): The number of nearest neighbors to search for. Defaults to 3.
+        ef (int, optional): The HNSW search depth, trading latency for recall. Defaults to 16.
 
     Returns:
         dict: A dictionary containing the request ID and a list of duplicate image names,
@@ -143,30 +279,13 @@ async def find_duplicates(request_id: str, threshold: float = 1.0, k: int = 3):
     if request_id not in vector_db.request_map:
         raise HTTPException(status_code=404, detail="Request ID not found")
 
-    start_index, _ = vector_db.request_map[request_id]
-
     try:
-        duplicates_indices = vector_db.search_duplicates(request_id, k)
+        duplicate_image_names = find_duplicate_names(request_id, threshold, k, ef, vector_db.version)
     except Exception as e:
         logger.error(f"Error during duplicate search: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error during search: {str(e)}")
 
-    all_duplicates = set()
-
-    for vector_key, results in duplicates_indices.items():
-        indices = results["indices"]
-        distances = results["distances"]
-
-        current_vector_number = int(vector_key.split('_')[1])
-        current_index = start_index + current_vector_number
-
-        for i in range(len(indices)):
-            if indices[i] != current_index and distances[i] <= threshold:
-                all_duplicates.add(indices[i])
-
-    if not all_duplicates:
+    if not duplicate_image_names:
         return {"message": "No duplicates found"}
 
-    duplicate_image_names = [vector_db.get_image_name(idx) for idx in all_duplicates]
-
-    return {"request_id": request_id, "duplicates": duplicate_image_names}
+    return {"request_id": request_id, "duplicates": list(duplicate_image_names)}
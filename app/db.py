@@ -1,71 +1,311 @@
+import os
+import asyncio
 import faiss
 import numpy as np
 import logging
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Dimension the vectors are reduced to with PCA, and the number of stored vectors the PCA is fitted on
+PCA_DIM = 256
+PCA_TRAINING_SIZE = 1024
+
+# Fraction of the indexed vectors that may be removed before the index is compacted
+COMPACTION_RATIO = 0.2
+
+# Most extra neighbors a GPU search fetches to make up for removed vectors, well within the
+# GPU FAISS limit of 2048 neighbors; GPU indexes are compacted once they hold more removed vectors
+GPU_MAX_TOMBSTONES = 256
+
 
 class VectorDB:
     """
     A simple vector database using FAISS for similarity search.
-    Manages image vectors, request IDs, and image names.
+    Vectors are L2-normalized, so the index ranks neighbors by inner product (cosine similarity).
+    Manages image vectors and request IDs; image names are derived from vector indices.
+
+    Once enough vectors are stored, a PCA projection to a lower dimension is fitted on them
+    and the index is rebuilt over the projected vectors, which cuts its memory and search cost.
+    Query vectors go through the same projection automatically. The rebuild runs in a worker
+    thread (see rebuild_index), while the current index keeps serving searches.
+
+    Removed vectors are only marked as removed and filtered out of search results,
+    since neither HNSW nor GPU indexes support removal. Once enough of them accumulate,
+    the index is compacted by the same background rebuild.
     """
 
-    def __init__(self, dim: int):
+    def __init__(self, dim: int, capacity: int = 1024):
         """
         Initializes the VectorDB with a given vector dimension.
 
         Args:
             dim (int): The dimension of the vectors to be stored.
+            capacity (int, optional): The number of vectors to preallocate storage for. Defaults to 1024.
         """
         self.dim = dim
-        self.index = faiss.IndexFlatL2(dim)  # Flat L2 distance index
-        self.vectors: List[List[float]] = []  # List to store vectors
+        self.gpu_resources = faiss.StandardGpuResources() if faiss.get_num_gpus() > 0 else None
+        self.pca: Optional[faiss.LinearTransform] = None  # Fitted once PCA_TRAINING_SIZE vectors are stored
+        self.index = self._to_device(self._build_index())
+        self._buf = np.empty((capacity, dim), dtype='float32')  # Preallocated vector storage
+        self._removed = np.zeros(capacity, dtype=bool)  # Marks the stored vectors of removed requests
+        # Packed bits of the positions that were not removed, kept in step with _removed and read
+        # in place by the ID selector restricting searches. New positions start out set, so only
+        # removals and reallocations update it
+        self._live_bitmap = np.full(-(-capacity // 8), 0xFF, dtype=np.uint8)
+        self._live_selector = faiss.IDSelectorBitmap(self._live_bitmap)
+        self._n = 0  # Number of stored vectors
+        self.tombstones = 0  # Number of removed vectors still in the index
         self.request_map: Dict[str, Tuple[int, int]] = {}  # Maps request_id to vector indices
-        self.image_names: List[str] = []  # List of image names
+        self.version = 0  # Incremented on every change to the stored vectors
+        self.rebuilding = False  # Whether an index rebuild is in progress
+        self._generation = 0  # Incremented on reset, invalidating rebuilds in progress
+
+    def _build_index(self, pca: Optional[faiss.LinearTransform] = None) -> faiss.Index:
+        """
+        Builds an empty FAISS index on the CPU, to be placed on the GPU with _to_device.
+        Vectors are added with their storage positions as IDs, so that removed vectors
+        can be filtered out of search results by ID.
+
+        HNSW is not supported by GPU FAISS, so with a GPU the index is a brute-force
+        flat inner product index, which the GPU scans in a single batched kernel.
+        If a PCA projection is given, the index stores the projected vectors, re-normalized
+        so that inner products remain cosine similarities.
+
+        Args:
+            pca (faiss.LinearTransform, optional): The fitted PCA projection to apply to the vectors.
+
+        Returns:
+            faiss.Index: The empty index.
+        """
+        dim = self.dim if pca is None else PCA_DIM
+
+        if self.gpu_resources is not None:
+            index = faiss.IndexFlatIP(dim)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)  # HNSW graph index over inner product
+            index.hnsw.efConstruction = 40
+            index.hnsw.efSearch = 16
+
+        # The ID map sits below the projection, so that ID selectors passed in the
+        # search parameters of the inner index are translated to storage positions
+        index = faiss.IndexIDMap(index)
+        if pca is not None:
+            index = faiss.IndexPreTransform(faiss.NormalizationTransform(dim), index)
+            index.prepend_transform(pca)
+
+        return index
+
+    def _to_device(self, index: faiss.Index) -> faiss.Index:
+        """
+        Moves an index to the GPU when one is available.
+
+        The GPU resources are not thread-safe, so this must only be called from the thread
+        that uses the current index, never from a rebuild running in a worker thread.
+
+        Args:
+            index (faiss.Index): The CPU index.
+
+        Returns:
+            faiss.Index: The index on the GPU, or the given index without a GPU.
+        """
+        if self.gpu_resources is None:
+            return index
+        return faiss.index_cpu_to_gpu(self.gpu_resources, 0, index)
+
+    def _live_ids(self) -> np.ndarray:
+        """
+        Returns the storage positions of the vectors of all requests that were not removed.
+
+        Returns:
+            np.ndarray: The int64 positions, in ascending order.
+        """
+        ranges = sorted(self.request_map.values())
+        if not ranges:
+            return np.empty(0, dtype='int64')
+        return np.concatenate([np.arange(start, end, dtype='int64') for start, end in ranges])
+
+    def _fit_pca(self, vectors: np.ndarray) -> faiss.LinearTransform:
+        """
+        Fits a projection of the given normalized vectors onto their PCA_DIM principal directions.
+
+        Unlike faiss.PCAMatrix, the vectors are not centered: centering would make the index
+        compare the vectors' deviations from their mean, so the same distance threshold would
+        match different images before and after the switch. Without it, the projection keeps
+        the directions carrying most of the vectors' energy, and inner products of the
+        re-normalized projected vectors approximate the original cosine similarities.
+
+        Args:
+            vectors (np.ndarray): A float32 array of shape (N, dim) with the vectors to fit on.
+
+        Returns:
+            faiss.LinearTransform: The fitted projection.
+        """
+        logger.info(f"Fitting PCA from {self.dim} to {PCA_DIM} dimensions on {len(vectors)} vectors")
+
+        _, _, components = np.linalg.svd(vectors, full_matrices=False)
+        pca = faiss.LinearTransform(self.dim, PCA_DIM, False)
+        faiss.copy_array_to_vector(np.ascontiguousarray(components[:PCA_DIM]).ravel(), pca.A)
+        pca.is_trained = True
+        return pca
+
+    def _build_index_from(self, vectors: np.ndarray, ids: np.ndarray,
+                          pca: Optional[faiss.LinearTransform]) -> Tuple[Optional[faiss.LinearTransform], faiss.Index]:
+        """
+        Builds a CPU index over the given vectors, fitting the PCA projection first if it is due.
+        Only touches its arguments, so that it can run in a worker thread.
+
+        Args:
+            vectors (np.ndarray): A float32 array of shape (N, dim) with the vectors to add.
+            ids (np.ndarray): The int64 storage positions of the vectors.
+            pca (faiss.LinearTransform, optional): The current PCA projection, if fitted.
+
+        Returns:
+            Tuple[Optional[faiss.LinearTransform], faiss.Index]: The PCA projection and the new index.
+        """
+        if pca is None and len(ids) >= PCA_TRAINING_SIZE:
+            pca = self._fit_pca(vectors)
+
+        index = self._build_index(pca)
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+        return pca, index
+
+    def rebuild_due(self) -> bool:
+        """
+        Returns whether the index should be rebuilt, which is the case once enough vectors
+        are stored to fit the PCA projection, or once the removed vectors exceed
+        COMPACTION_RATIO of the indexed ones, or GPU_MAX_TOMBSTONES on the GPU.
+
+        Returns:
+            bool: True if a rebuild is due.
+        """
+        if self.pca is None and self.index.ntotal - self.tombstones >= PCA_TRAINING_SIZE:
+            return True
+        if self.gpu_resources is not None and self.tombstones > GPU_MAX_TOMBSTONES:
+            return True
+        return self.tombstones > 0 and self.tombstones >= COMPACTION_RATIO * self.index.ntotal
+
+    async def rebuild_index(self):
+        """
+        Rebuilds the index if it is due, without blocking the event loop.
 
-    def add_vectors(self, request_id: str, vectors: List[List[float]]):
+        The vectors of the requests that were not removed are snapshotted and the new index
+        is built from them on the CPU in a worker thread, while the current index keeps serving
+        searches. Back on the event loop, the new index is moved to the GPU if there is one,
+        and vectors added in the meantime are added to it before it replaces the current one.
+        Vectors removed in the meantime remain as its tombstones. If the database was reset
+        in the meantime, the new index is discarded.
+        """
+        if self.rebuilding or not self.rebuild_due():
+            return
+
+        self.rebuilding = True
+        try:
+            generation = self._generation
+            n = self._n
+            ids = self._live_ids()
+            vectors = self._buf[ids]  # A copy, as the storage may be reallocated during the rebuild
+
+            pca, index = await asyncio.to_thread(self._build_index_from, vectors, ids, self.pca)
+            if generation != self._generation:
+                return
+
+            index = self._to_device(index)
+            added_ids = self._live_ids()
+            added_ids = added_ids[added_ids >= n]
+            if len(added_ids):
+                index.add_with_ids(self._buf[added_ids], added_ids)
+
+            self.pca = pca
+            self.index = index
+            self.tombstones = int(self._removed[ids].sum())
+            self.version += 1
+
+            logger.info(f"Rebuilt index over {self.index.ntotal} vectors")
+        finally:
+            self.rebuilding = False
+
+    def _reserve(self, capacity: int):
+        """
+        Grows the vector storage to hold at least `capacity` vectors, doubling its size as needed.
+
+        Args:
+            capacity (int): The required number of vectors.
+        """
+        if capacity <= len(self._buf):
+            return
+
+        new_size = max(len(self._buf), 1)
+        while new_size < capacity:
+            new_size *= 2
+
+        buf = np.empty((new_size, self.dim), dtype='float32')
+        buf[:self._n] = self._buf[:self._n]
+        self._buf = buf
+
+        removed = np.zeros(new_size, dtype=bool)
+        removed[:self._n] = self._removed[:self._n]
+        self._removed = removed
+
+        self._live_bitmap = np.packbits(~removed, bitorder='little')
+        self._live_selector = faiss.IDSelectorBitmap(self._live_bitmap)
+
+    def add_vectors(self, request_id: str, vectors: np.ndarray) -> Tuple[int, int]:
         """
         Adds vectors to the index and updates mappings.
 
         Args:
             request_id (str): The unique identifier for the request.
-            vectors (List[List[float]]): A list of vectors to add.
+            vectors (np.ndarray): A float32 array of shape (N, dim) with the vectors to add.
+
+        Returns:
+            Tuple[int, int]: The start (inclusive) and end (exclusive) indices assigned to the vectors.
 
         Raises:
             ValueError: If the vectors have incorrect dimensions.
         """
-        vectors_np = np.array(vectors, dtype='float32')
+        vectors_np = np.ascontiguousarray(vectors, dtype='float32')  # No copy for contiguous float32 input
         if vectors_np.ndim != 2 or vectors_np.shape[1] != self.dim:
             raise ValueError(f"Expected vector dimension {self.dim}, but got {vectors_np.shape[1]}")
 
         logger.info(f"Adding vectors for request_id: {request_id}, vectors shape: {vectors_np.shape}")
 
-        # Add vectors to FAISS index
-        self.index.add(vectors_np)
-
-        # Update mappings and lists
-        start_index = len(self.vectors)
-        end_index = start_index + len(vectors)
-        new_image_names = [f"image_{i}" for i in range(start_index + 1, end_index + 1)]
+        # Store the vectors and normalize them in place, so inner products are cosine similarities
+        start_index = self._n
+        end_index = start_index + len(vectors_np)
+        self._reserve(end_index)
+        stored_vectors = self._buf[start_index:end_index]
+        stored_vectors[:] = vectors_np
+        faiss.normalize_L2(stored_vectors)
 
-        self.image_names.extend(new_image_names)
+        # Update mappings
         self.request_map[request_id] = (start_index, end_index)
-        self.vectors.extend(vectors)
+        self._n = end_index
+
+        # Add vectors to FAISS index
+        self.index.add_with_ids(stored_vectors, np.arange(start_index, end_index, dtype='int64'))
+
+        self.version += 1
 
         logger.info(f"Total vectors in index after addition: {self.index.ntotal}")
 
-    def search_duplicates(self, request_id: str, k: int = 3) -> Dict[str, Dict[str, List]]:
+        return start_index, end_index
+
+    def search_duplicates(self, request_id: str, k: int = 3, ef: int = 16) -> Tuple[np.ndarray, np.ndarray]:
         """
         Searches for duplicates of vectors associated with a request ID.
 
         Args:
             request_id (str): The request ID to search duplicates for.
             k (int, optional): The number of nearest neighbors to retrieve. Defaults to 3.
+            ef (int, optional): The HNSW search depth, trading latency for recall. Raised to k
+                if lower, since the search cannot return more neighbors than it explores.
+                Ignored for the GPU index. Defaults to 16.
 
         Returns:
-            Dict[str, Dict[str, List]]: A dictionary containing distances and indices of nearest neighbors.
+            Tuple[np.ndarray, np.ndarray]: The inner products and indices of the nearest neighbors,
+                each of shape (number of request vectors, k).
 
         Raises:
             ValueError: If the request ID is not found.
@@ -74,21 +314,64 @@ class VectorDB:
             raise ValueError("Request ID not found")
 
         start_index, end_index = self.request_map[request_id]
-        query_vectors = np.array(self.vectors[start_index:end_index], dtype='float32')
+        query_vectors = self._buf[start_index:end_index]
         logger.info(f"Searching duplicates for request_id: {request_id}, query vectors shape: {query_vectors.shape}")
 
-        # Search for nearest neighbors
-        distances, indices = self.index.search(query_vectors, k)
+        # Search for nearest neighbors (the search depth only applies to the CPU HNSW index)
+        if self.gpu_resources is None:
+            hnsw_params = params = faiss.SearchParametersHNSW(efSearch=max(ef, k))
+            if self.tombstones:
+                # Restrict the search to the vectors that were not removed
+                hnsw_params.sel = self._live_selector
+            if self.pca is not None:
+                params = faiss.SearchParametersPreTransform(index_params=hnsw_params)
+            distances, indices = self.index.search(query_vectors, k, params=params)
+        else:
+            # GPU indexes take no ID selector, so fetch extra neighbors to drop the removed ones.
+            # Until the index is compacted, a removed vector beyond the first GPU_MAX_TOMBSTONES
+            # may take the place of a live neighbor
+            distances, indices = self.index.search(query_vectors, k + min(self.tombstones, GPU_MAX_TOMBSTONES))
+            if self.tombstones:
+                removed = (indices >= 0) & self._removed[indices]
+                indices[removed] = -1
+                distances[removed] = -np.inf
+                order = np.argsort(removed, axis=1, kind='stable')[:, :k]
+                distances = np.take_along_axis(distances, order, axis=1)
+                indices = np.take_along_axis(indices, order, axis=1)
         logger.info(f"Search results for request_id: {request_id}, distances: {distances}, indices: {indices}")
 
-        duplicates = {}
-        for i, (dist, ind) in enumerate(zip(distances, indices)):
-            duplicates[f"vector_{i}"] = {
-                "indices": ind.tolist(),
-                "distances": dist.tolist()
-            }
+        return distances, indices
+
+    def remove_request(self, request_id: str):
+        """
+        Removes the vectors associated with a request ID from the index.
+
+        The vectors are marked as removed and filtered out of search results until the index
+        is compacted by rebuild_index. Their storage positions are not reused, so the names
+        of other images do not change.
+
+        Args:
+            request_id (str): The request ID to remove.
+
+        Raises:
+            ValueError: If the request ID is not found.
+        """
+        if request_id not in self.request_map:
+            raise ValueError("Request ID not found")
+
+        start_index, end_index = self.request_map.pop(request_id)
+        logger.info(f"Removing vectors for request_id: {request_id}, indices: [{start_index}, {end_index})")
 
-        return duplicates
+        self._removed[start_index:end_index] = True
+        self.tombstones += end_index - start_index
+
+        # Repack only the bytes of the live bitmap covering the removed positions
+        first_byte, end_byte = start_index // 8, -(-end_index // 8)
+        self._live_bitmap[first_byte:end_byte] = np.packbits(
+            ~self._removed[first_byte * 8:end_byte * 8], bitorder='little')
+        self.version += 1
+
+        logger.info(f"Removed vectors awaiting compaction: {self.tombstones} of {self.index.ntotal}")
 
     def get_image_name(self, index: int) -> str:
         """
@@ -100,19 +383,37 @@ class VectorDB:
         Returns:
             str: The image name if found, else None.
         """
-        if 0 <= index < len(self.image_names):
-            return self.image_names[index]
+        if 0 <= index < self._n:
+            return f"image_{index + 1}"
         return None
 
+    def get_image_names(self, indices: np.ndarray) -> List[str]:
+        """
+        Retrieves the image names corresponding to an array of indices.
+
+        Args:
+            indices (np.ndarray): The indices of the images, all of which must be stored.
+
+        Returns:
+            List[str]: The image names, in the order of the indices.
+        """
+        return [f"image_{index + 1}" for index in indices.tolist()]
+
     def reset(self):
         """
         Resets the vector database by clearing the index and internal data structures.
         """
-        self.index.reset()
-        self.vectors.clear()
+        self.pca = None
+        self.index = self._to_device(self._build_index())
+        self._removed[:self._n] = False
+        self._live_bitmap[:] = 0xFF
+        self._n = 0
+        self.tombstones = 0
         self.request_map.clear()
-        self.image_names.clear()
+        self.version += 1
+        self._generation += 1
 
 
-# Initialize a global instance of VectorDB with vector dimension 2048
-vector_db = VectorDB(2048)
+# Initialize a global instance of VectorDB with vector dimension 2048,
+# preallocating storage for the expected number of vectors
+vector_db = VectorDB(2048, capacity=int(os.environ.get("VECTOR_DB_CAPACITY", "1024")))
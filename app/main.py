@@ -2,13 +2,47 @@
 The main module for running the FastAPI application.
 """
 
+import io
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from PIL import Image
 from fastapi import FastAPI
 from app.api import router as image_router
+from app.models.image_model import _compute_vectors, IMAGE_SIZE
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-app = FastAPI()
+
+def warmup():
+    """
+    Runs a dummy image through the full vectorization pipeline (JPEG decoding,
+    the Numba preprocessing kernel and the ONNX Runtime session), so that one-time
+    costs such as JIT compilation and kernel selection are paid at startup
+    instead of on the first request. The vector cache is bypassed, so the dummy
+    image leaves no entry behind.
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (IMAGE_SIZE, IMAGE_SIZE)).save(buffer, format='JPEG')
+    _compute_vectors([buffer.getvalue()])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Sets up a bounded thread pool for blocking work, such as model inference,
+    for the lifetime of the application, and warms up the vectorization pipeline.
+    """
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    asyncio.get_running_loop().set_default_executor(executor)
+    await asyncio.to_thread(warmup)
+    yield
+    executor.shutdown(wait=True)
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(image_router)
 
 
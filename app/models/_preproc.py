@@ -0,0 +1,99 @@
+import numba
+import numpy as np
+
+# The kernel is launched concurrently from executor threads, which needs a threadsafe layer;
+# prefer OpenMP over TBB, whose worker pool can hang on interpreter exit once used from several threads
+numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+# Input size expected by the model
+IMAGE_SIZE = 224
+
+# ImageNet normalization constants, with the std inverted to multiply instead of divide
+MEAN = np.array([0.485, 0.456, 0.406], dtype='float32')
+INV_STD = (1.0 / np.array([0.229, 0.224, 0.225])).astype('float32')
+
+
+@numba.njit(cache=True)
+def _filter_weights(in_size: int, out_size: int):
+    """
+    Computes the taps of an antialiased bilinear (triangle) filter resampling one axis.
+
+    As in PIL's bilinear resize, the filter support is stretched by the scale factor when
+    downscaling, so each output pixel averages its whole source footprint instead of
+    sampling only the two nearest source pixels.
+
+    Args:
+        in_size (int): The size of the source axis.
+        out_size (int): The size of the output axis.
+
+    Returns:
+        tuple: The first source index of each output pixel, the number of taps of each output
+            pixel, and the normalized tap weights as an array of shape (out_size, max taps).
+    """
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = filter_scale
+    max_taps = int(np.ceil(support)) * 2 + 1
+
+    starts = np.empty(out_size, dtype=np.int64)
+    counts = np.empty(out_size, dtype=np.int64)
+    weights = np.zeros((out_size, max_taps), dtype=np.float32)
+
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        start = max(int(center - support + 0.5), 0)
+        stop = min(int(center + support + 0.5), in_size)
+        count = min(stop - start, max_taps)
+
+        total = 0.0
+        for j in range(count):
+            weight = max(1.0 - abs((start + j - center + 0.5) / filter_scale), 0.0)
+            weights[i, j] = weight
+            total += weight
+        if total > 0.0:
+            for j in range(count):
+                weights[i, j] /= total
+
+        starts[i] = start
+        counts[i] = count
+
+    return starts, counts, weights
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def fused_resize_norm(image: np.ndarray, mean: np.ndarray, inv_std: np.ndarray, out: np.ndarray):
+    """
+    Resizes an RGB image with an antialiased bilinear filter and normalizes it in a single pass.
+
+    Each output pixel is resampled from its source footprint, scaled to [0, 1] and
+    normalized with the given mean and inverse standard deviation, then written
+    in channel-first order. Output rows are processed in parallel.
+
+    Args:
+        image (np.ndarray): The source image as a uint8 array of shape (H, W, 3).
+        mean (np.ndarray): The per-channel mean as a float32 array of shape (3,).
+        inv_std (np.ndarray): The per-channel inverse standard deviation as a float32 array of shape (3,).
+        out (np.ndarray): The preallocated float32 output array of shape (3, out_H, out_W).
+    """
+    out_h, out_w = out.shape[1], out.shape[2]
+    y_starts, y_counts, y_weights = _filter_weights(image.shape[0], out_h)
+    x_starts, x_counts, x_weights = _filter_weights(image.shape[1], out_w)
+
+    for y in numba.prange(out_h):
+        for x in range(out_w):
+            r = 0.0
+            g = 0.0
+            b = 0.0
+            for ky in range(y_counts[y]):
+                sy = y_starts[y] + ky
+                wy = y_weights[y, ky]
+                for kx in range(x_counts[x]):
+                    sx = x_starts[x] + kx
+                    w = wy * x_weights[x, kx]
+                    r += image[sy, sx, 0] * w
+                    g += image[sy, sx, 1] * w
+                    b += image[sy, sx, 2] * w
+
+            out[0, y, x] = (r * (1.0 / 255.0) - mean[0]) * inv_std[0]
+            out[1, y, x] = (g * (1.0 / 255.0) - mean[1]) * inv_std[1]
+            out[2, y, x] = (b * (1.0 / 255.0) - mean[2]) * inv_std[2]
@@ -0,0 +1,131 @@
+"""
+Build step exporting the ResNet50 feature extractor to ONNX for serving with ONNX Runtime.
+
+Usage:
+    python -m app.models.export_onnx [--output PATH] [--calibration-dir DIR | --fp16]
+
+When a calibration directory is given, the exported model is statically quantized
+to INT8 using the images in that directory to calibrate the activation ranges.
+With --fp16, the model is exported in FP16 for serving on the GPU.
+"""
+
+import os
+import argparse
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+import torchvision.models as models
+from torchvision.models import ResNet50_Weights
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from PIL import Image
+
+from app.models._preproc import fused_resize_norm, MEAN, INV_STD, IMAGE_SIZE
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """
+    Feeds the images of a directory, preprocessed like at serving time, to the INT8 calibrator.
+    """
+
+    def __init__(self, image_dir: str):
+        """
+        Initializes the reader with a directory of JPEG or PNG images.
+
+        Args:
+            image_dir (str): The directory containing the calibration images.
+        """
+        self.paths = iter(sorted(
+            os.path.join(image_dir, name) for name in os.listdir(image_dir)
+            if name.lower().endswith((".jpg", ".jpeg", ".png"))
+        ))
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Returns the next preprocessed calibration image, or None when all images were read.
+        """
+        path = next(self.paths, None)
+        if path is None:
+            return None
+
+        batch = np.empty((1, 3, IMAGE_SIZE, IMAGE_SIZE), dtype='float32')
+        with Image.open(path) as image:
+            fused_resize_norm(np.asarray(image.convert('RGB')), MEAN, INV_STD, batch[0])
+        return {"input": batch}
+
+
+class HalfPrecisionModel(torch.nn.Module):
+    """
+    Runs a model in FP16 while keeping FP32 inputs and outputs, so the served interface is unchanged.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model.half()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model(x.half()).float()
+
+
+def export_model(model_path: str, calibration_dir: Optional[str] = None, fp16: bool = False):
+    """
+    Exports the pre-trained ResNet50 model without its final FC layer to ONNX.
+
+    Args:
+        model_path (str): The path to write the ONNX model to.
+        calibration_dir (str, optional): A directory of representative images to calibrate
+            INT8 quantization with. If not given, the model is exported in FP32.
+        fp16 (bool, optional): Whether to export the model in FP16, for the CUDA execution
+            provider. Inputs and outputs remain FP32. Defaults to False.
+
+    The model is written to a temporary file and moved into place once complete, so that
+    concurrent readers never load a partially written model.
+    """
+    if fp16 and calibration_dir is not None:
+        raise ValueError("A model cannot be exported both in FP16 and quantized to INT8")
+
+    model = models.resnet50(weights=ResNet50_Weights.IMAGENET1K_V1)
+    model = torch.nn.Sequential(*list(model.children())[:-1])
+    if fp16:
+        model = HalfPrecisionModel(model)
+    model.eval()
+
+    os.makedirs(os.path.dirname(os.path.abspath(model_path)), exist_ok=True)
+    tmp_path = f"{model_path}.{os.getpid()}.tmp"
+    fp32_path = tmp_path if calibration_dir is None else f"{model_path}.{os.getpid()}.fp32.tmp"
+
+    # Fix the input to (batch, 3, 224, 224), leaving only the batch dimension dynamic
+    torch.onnx.export(
+        model,
+        torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE),
+        fp32_path,
+        input_names=["input"],
+        output_names=["features"],
+        dynamic_axes={"input": {0: "batch"}, "features": {0: "batch"}},
+        opset_version=17,
+    )
+
+    if calibration_dir is not None:
+        quantize_static(
+            fp32_path,
+            tmp_path,
+            ImageCalibrationReader(calibration_dir),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        os.remove(fp32_path)
+
+    os.replace(tmp_path, model_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the ResNet50 feature extractor to ONNX.")
+    parser.add_argument("--output", default=os.environ.get(
+        "MODEL_PATH", os.path.join(os.path.dirname(__file__), "resnet50.onnx")))
+    parser.add_argument("--calibration-dir", default=None)
+    parser.add_argument("--fp16", action="store_true")
+    args = parser.parse_args()
+
+    export_model(args.output, args.calibration_dir, args.fp16)
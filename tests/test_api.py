@@ -1,11 +1,13 @@
 import io
 import base64
+import faiss
 import pytest
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, MagicMock, AsyncMock
 from fastapi.testclient import TestClient
 
 from app.main import app
 from app.db import vector_db
+from app.models import image_model
 
 # Constants for test images
 TEST_IMAGE_DIR = 'test_images'
@@ -82,14 +84,16 @@ def test_add_images_via_urls(test_client, test_images):
     # Map URLs to image content
     url_to_content = dict(zip(image_urls, [content for _, content in test_images]))
 
-    # Mock function for requests.get
-    def mock_requests_get(url, *args, **kwargs):
+    # Mock function for aiohttp.ClientSession.get
+    def mock_session_get(url, *args, **kwargs):
         mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = url_to_content[url]
-        return mock_response
+        mock_response.status = 200
+        mock_response.content.read = AsyncMock(side_effect=[url_to_content[url], b''])
+        mock_context = MagicMock()
+        mock_context.__aenter__.return_value = mock_response
+        return mock_context
 
-    with patch('requests.get', side_effect=mock_requests_get):
+    with patch('aiohttp.ClientSession.get', side_effect=mock_session_get):
         json_data = {
             "image_urls": image_urls
         }
@@ -102,6 +106,89 @@ def test_add_images_via_urls(test_client, test_images):
         assert len(data['system_image_names']) == len(test_images)
 
 
+def test_add_images_via_urls_with_failed_download(test_client, test_images):
+    """
+    Test that a failed download rejects the request.
+    """
+    image_urls = [
+        "http://example.com/test_image_1.jpg",
+        "http://example.com/missing.jpg"
+    ]
+
+    # Mock function for aiohttp.ClientSession.get, failing for the missing image
+    def mock_session_get(url, *args, **kwargs):
+        mock_response = Mock()
+        mock_response.status = 404 if url.endswith("missing.jpg") else 200
+        mock_response.content.read = AsyncMock(side_effect=[test_images[0][1], b''])
+        mock_context = MagicMock()
+        mock_context.__aenter__.return_value = mock_response
+        return mock_context
+
+    with patch('aiohttp.ClientSession.get', side_effect=mock_session_get):
+        response = test_client.post("/images", json={"image_urls": image_urls})
+        assert response.status_code == 400
+        assert 'missing.jpg' in response.json()['detail']
+
+
+def test_add_images_exceeding_size_limit(test_client):
+    """
+    Test that images larger than 10 MB are rejected.
+    """
+    files = [('files', ('large.jpg', io.BytesIO(b'\0' * (10 * 1024 * 1024 + 1)), 'image/jpeg'))]
+
+    response = test_client.post("/images", files=files)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Image size exceeds 10 MB'
+
+
+def test_add_base64_image_exceeding_size_limit(test_client):
+    """
+    Test that Base64-encoded images decoding to more than 10 MB are rejected before decoding.
+    """
+    json_data = {
+        "base64_images": ['A' * (14 * 1024 * 1024)]
+    }
+
+    response = test_client.post("/images", json=json_data)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Image size exceeds 10 MB'
+
+
+def test_add_base64_image_exceeding_size_limit_after_decoding(test_client):
+    """
+    Test that the exact size limit is enforced on the decoded Base64 image.
+    """
+    json_data = {
+        "base64_images": [base64.b64encode(b'\0' * (10 * 1024 * 1024 + 1)).decode('utf-8')]
+    }
+
+    response = test_client.post("/images", json=json_data)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Image size exceeds 10 MB'
+
+
+@pytest.mark.parametrize('image_b64', [42, None])
+def test_add_non_string_base64_image(test_client, image_b64):
+    """
+    Test that a Base64 image that is not a string is rejected.
+    """
+    response = test_client.post("/images", json={'base64_images': [image_b64]})
+    assert response.status_code == 400
+
+
+def test_add_images_via_mime_wrapped_base64(test_client, test_images):
+    """
+    Test adding images via Base64 data wrapped into lines.
+    """
+    json_data = {
+        "base64_images": [base64.encodebytes(content).decode('utf-8') for _, content in test_images]
+    }
+
+    response = test_client.post("/images", json=json_data)
+    assert response.status_code == 200
+    assert response.json()['added_images'] == len(test_images)
+
+
 def test_find_duplicates_with_duplicates(test_client, test_images):
     """
     Test finding duplicates when duplicates are present.
@@ -127,6 +214,24 @@ def test_find_duplicates_with_duplicates(test_client, test_images):
     assert len(data['duplicates']) >= 1
 
 
+def test_find_duplicates_search_depth(test_client, test_images):
+    """
+    Test that a search depth below k still finds the duplicates, and that a non-positive one is rejected.
+    """
+    files = [('files', (filename, io.BytesIO(content), 'image/jpeg')) for filename, content in test_images]
+    test_client.post("/images", files=files)
+
+    files = [('files', ('duplicate.jpg', io.BytesIO(test_images[0][1]), 'image/jpeg'))]
+    request_id = test_client.post("/images", files=files).json()['request_id']
+
+    response = test_client.get(f"/duplicates/{request_id}", params={'threshold': 0.0, 'k': 4, 'ef': 1})
+    assert response.status_code == 200
+    assert response.json()['duplicates'] == ['image_1']
+
+    response = test_client.get(f"/duplicates/{request_id}", params={'ef': 0})
+    assert response.status_code == 422
+
+
 def test_find_duplicates_no_duplicates(test_client, test_images):
     """
     Test finding duplicates when no duplicates are present.
@@ -146,3 +251,133 @@ def test_find_duplicates_no_duplicates(test_client, test_images):
     data = response.json()
     assert 'message' in data
     assert data['message'] == 'No duplicates found'
+
+
+def test_remove_images(test_client, test_images):
+    """
+    Test removing images by request ID.
+    """
+    content = test_images[0][1]
+    files = [('files', ('image.jpg', io.BytesIO(content), 'image/jpeg'))]
+
+    first_request_id = test_client.post("/images", files=files).json()['request_id']
+    second_request_id = test_client.post("/images", files=files).json()['request_id']
+
+    # The images of both requests are duplicates of each other
+    response = test_client.get(f"/duplicates/{second_request_id}", params={'threshold': 0.0, 'k': 2})
+    assert response.json()['duplicates'] == ['image_1']
+
+    response = test_client.delete(f"/images/{first_request_id}")
+    assert response.status_code == 200
+    assert response.json()['removed_images'] == 1
+
+    # The removed request is gone, and its image is no longer reported as a duplicate
+    response = test_client.get(f"/duplicates/{first_request_id}")
+    assert response.status_code == 404
+
+    response = test_client.get(f"/duplicates/{second_request_id}", params={'threshold': 0.0, 'k': 2})
+    assert response.status_code == 200
+    assert response.json()['message'] == 'No duplicates found'
+
+
+@pytest.mark.parametrize('compaction_ratio', [0.0, 1.0])
+def test_remove_images_keeps_other_requests(test_client, test_images, compaction_ratio):
+    """
+    Test that removing a request leaves the images of other requests searchable,
+    both when the index is compacted right away and while it still holds the removed images.
+    """
+    def post(content):
+        files = [('files', ('image.jpg', io.BytesIO(content), 'image/jpeg'))]
+        return test_client.post("/images", files=files).json()['request_id']
+
+    with patch('app.db.COMPACTION_RATIO', compaction_ratio):
+        removed_request_id = post(test_images[0][1])
+        first_request_id = post(test_images[1][1])
+        second_request_id = post(test_images[1][1])
+
+        response = test_client.delete(f"/images/{removed_request_id}")
+        assert response.status_code == 200
+        assert vector_db.tombstones == (0 if compaction_ratio < 1 else 1)
+
+        response = test_client.get(f"/duplicates/{first_request_id}", params={'threshold': 0.0})
+        assert response.json()['duplicates'] == ['image_3']
+
+        response = test_client.get(f"/duplicates/{second_request_id}", params={'threshold': 0.0})
+        assert response.json()['duplicates'] == ['image_2']
+
+
+def test_find_duplicates_is_cached_until_images_are_added(test_client, test_images):
+    """
+    Test that repeated duplicate queries skip the index search until new images are added.
+    """
+    files = [('files', (filename, io.BytesIO(content), 'image/jpeg')) for filename, content in test_images]
+    request_id = test_client.post("/images", files=files).json()['request_id']
+
+    with patch.object(vector_db, 'search_duplicates', wraps=vector_db.search_duplicates) as mock_search:
+        for _ in range(2):
+            response = test_client.get(f"/duplicates/{request_id}", params={'threshold': 0.0, 'k': 2})
+            assert response.status_code == 200
+        assert mock_search.call_count == 1
+
+        # Adding images changes the database version, invalidating the cached result
+        files = [('files', ('duplicate.jpg', io.BytesIO(test_images[0][1]), 'image/jpeg'))]
+        test_client.post("/images", files=files)
+
+        response = test_client.get(f"/duplicates/{request_id}", params={'threshold': 0.0, 'k': 2})
+        assert mock_search.call_count == 2
+        assert response.json()['duplicates'] == ['image_4']
+
+
+def test_reuploaded_image_skips_inference(test_client, test_images):
+    """
+    Test that vectors of previously seen images are served from the vector cache.
+    """
+    image_model._vector_cache.clear()
+    content = test_images[0][1]
+
+    with patch.object(image_model, '_compute_vectors', wraps=image_model._compute_vectors) as mock_compute:
+        for _ in range(2):
+            files = [('files', ('image.jpg', io.BytesIO(content), 'image/jpeg'))]
+            response = test_client.post("/images", files=files)
+            assert response.status_code == 200
+        assert mock_compute.call_count == 1
+
+
+def test_pca_is_fitted_once_enough_vectors_are_stored(test_client, test_images):
+    """
+    Test that the index switches to PCA-reduced vectors once enough are stored, that searches
+    go through the projection and still find duplicates, and that resetting drops the PCA.
+    """
+    files = [('files', (filename, io.BytesIO(content), 'image/jpeg')) for filename, content in test_images]
+    duplicate_files = [('files', ('image.jpg', io.BytesIO(test_images[0][1]), 'image/jpeg'))]
+
+    with patch('app.db.PCA_DIM', 3), patch('app.db.PCA_TRAINING_SIZE', 3), \
+            patch.object(faiss, 'SearchParametersPreTransform', wraps=faiss.SearchParametersPreTransform) as params:
+        test_client.post("/images", files=files)
+
+        # The PCA is fitted by the background rebuild after the response
+        assert vector_db.pca is not None
+        assert vector_db.index.ntotal == 3
+
+        request_id = test_client.post("/images", files=duplicate_files).json()['request_id']
+        assert vector_db.index.ntotal == 4
+
+        response = test_client.get(f"/duplicates/{request_id}", params={'threshold': 0.0})
+        assert response.json()['duplicates'] == ['image_1']
+        assert params.called
+
+    vector_db.reset()
+    assert vector_db.pca is None
+
+
+def test_warmup_leaves_vector_cache_empty():
+    """
+    Test that the startup warm-up does not leave its dummy image in the vector cache.
+    """
+    image_model._vector_cache.clear()
+
+    # Entering the client runs the application's lifespan, including the warm-up
+    with TestClient(app):
+        pass
+
+    assert len(image_model._vector_cache) == 0
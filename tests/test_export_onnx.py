@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import onnx
+import onnxruntime as ort
+import torch
+import torchvision.models as models
+from unittest.mock import patch
+
+from app.models.export_onnx import export_model
+from app.models._preproc import IMAGE_SIZE
+
+# Directory of images to calibrate the INT8 export with
+TEST_IMAGE_DIR = 'test_images'
+
+# The pretrained weights do not affect the exported graph, so export randomly initialized models
+resnet50 = models.resnet50
+
+
+def untrained_resnet50(weights=None):
+    return resnet50(weights=None)
+
+
+@patch('torchvision.models.resnet50', untrained_resnet50)
+def test_export_int8_model(tmp_path):
+    """
+    Test that the calibrated export produces an INT8 model with the served input and output.
+    """
+    model_path = str(tmp_path / 'resnet50.onnx')
+    export_model(model_path, calibration_dir=TEST_IMAGE_DIR)
+
+    # Only the final model is left behind, not the FP32 intermediate
+    assert os.listdir(tmp_path) == ['resnet50.onnx']
+
+    # Every convolution reads its weights through a dequantized INT8 initializer
+    graph = onnx.load(model_path).graph
+    dequantized = {node.output[0] for node in graph.node if node.op_type == 'DequantizeLinear'}
+    convs = [node for node in graph.node if node.op_type == 'Conv']
+    assert len(convs) == 53
+    assert all(conv.input[1] in dequantized for conv in convs)
+
+    session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    batch = np.random.randn(2, 3, IMAGE_SIZE, IMAGE_SIZE).astype('float32')
+    features = session.run(None, {'input': batch})[0]
+    assert features.shape == (2, 2048, 1, 1)
+
+
+@patch('torchvision.models.resnet50', untrained_resnet50)
+def test_export_fp16_model(tmp_path):
+    """
+    Test that the FP16 export stores FP16 weights, keeps FP32 input and output,
+    and produces the same features as the FP32 export up to rounding.
+    """
+    fp32_path = str(tmp_path / 'resnet50.onnx')
+    fp16_path = str(tmp_path / 'resnet50_fp16.onnx')
+    torch.manual_seed(0)
+    export_model(fp32_path)
+    torch.manual_seed(0)
+    export_model(fp16_path, fp16=True)
+
+    graph = onnx.load(fp16_path).graph
+    assert all(initializer.data_type != onnx.TensorProto.FLOAT for initializer in graph.initializer)
+    assert graph.input[0].type.tensor_type.elem_type == onnx.TensorProto.FLOAT
+    assert graph.output[0].type.tensor_type.elem_type == onnx.TensorProto.FLOAT
+
+    batch = np.random.randn(2, 3, IMAGE_SIZE, IMAGE_SIZE).astype('float32')
+    features = [
+        ort.InferenceSession(path, providers=['CPUExecutionProvider']).run(None, {'input': batch})[0].reshape(2, -1)
+        for path in (fp32_path, fp16_path)
+    ]
+    similarities = (features[0] * features[1]).sum(axis=1) / (
+        np.linalg.norm(features[0], axis=1) * np.linalg.norm(features[1], axis=1))
+    assert np.all(similarities > 0.999)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.models._preproc import fused_resize_norm, MEAN, INV_STD, IMAGE_SIZE
+
+# Constants for test images
+TEST_IMAGE_DIR = 'test_images'
+TEST_IMAGE_FILENAMES = ['test_image_1.jpg', 'test_image_2.jpg', 'test_image_3.jpg']
+
+
+def preprocess(image: Image.Image) -> np.ndarray:
+    """
+    Preprocesses an image with the fused resize and normalization kernel.
+    """
+    out = np.empty((3, IMAGE_SIZE, IMAGE_SIZE), dtype='float32')
+    fused_resize_norm(np.asarray(image.convert('RGB')), MEAN, INV_STD, out)
+    return out
+
+
+def preprocess_reference(image: Image.Image) -> np.ndarray:
+    """
+    Preprocesses an image with PIL's bilinear resize followed by normalization.
+    """
+    resized = image.convert('RGB').resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+    pixels = np.asarray(resized, dtype='float32') / 255.0
+    return ((pixels - MEAN) * INV_STD).transpose(2, 0, 1)
+
+
+@pytest.mark.parametrize('filename', TEST_IMAGE_FILENAMES)
+def test_fused_resize_norm_matches_pil(filename):
+    """
+    Test that the kernel matches PIL's antialiased bilinear resize up to PIL's 8-bit rounding.
+    """
+    with Image.open(f'{TEST_IMAGE_DIR}/{filename}') as image:
+        difference = np.abs(preprocess(image) - preprocess_reference(image))
+
+    assert difference.mean() < 0.01
+    assert difference.max() < 0.05
+
+
+@pytest.mark.parametrize('filename', TEST_IMAGE_FILENAMES)
+def test_fused_resize_norm_is_stable_under_downscaling(filename):
+    """
+    Test that a downscaled copy of an image preprocesses to nearly the same input,
+    as it does with PIL, instead of aliasing.
+    """
+    with Image.open(f'{TEST_IMAGE_DIR}/{filename}') as image:
+        half = image.resize((image.width // 2, image.height // 2), Image.BILINEAR)
+        difference = np.abs(preprocess(image) - preprocess(half)).mean()
+        reference_difference = np.abs(preprocess_reference(image) - preprocess_reference(half)).mean()
+
+    assert difference < reference_difference * 1.5